@@ -50,10 +50,9 @@ class ActionNet(nn.Module):
 
         assert d == 3, 'Input should be Euler angles.'
 
-        harmonics = self.item_rep.expand(n, -1, -1)
         item = block_wigner_matrix_multiply(
-            angles, harmonics, self.degrees, transpose=self.transpose) \
-            .view(-1, self.matrix_dims * self.rep_copies)
+            angles, self.item_rep, self.degrees, transpose=self.transpose) \
+            .view(n, self.matrix_dims * self.rep_copies)
 
         if self.mlp:
             item = self.mlp(item)
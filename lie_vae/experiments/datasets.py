@@ -1,15 +1,18 @@
 import re
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
-import os.path
-from glob import glob
+import os
 
 import torch
-from PIL import Image
 from torch.utils.data import Dataset, TensorDataset
+from torchvision.io import read_image, ImageReadMode
 
-from lie_learn.groups.SO3 import change_coordinates as SO3_coordinates
-from lie_vae.lie_tools import block_wigner_matrix_multiply, random_quaternions, quaternions_to_eazyz
+from lie_vae.lie_tools import block_wigner_matrix_multiply, random_quaternions, \
+    quaternions_to_eazyz, quaternions_to_group_matrix
+
+_QUAT_RE = re.compile(r'-?[01]\.[0-9]{4}')
+_NAME_RE = re.compile(r'([A-Za-z0-9]+)\.obj')
 
 
 class ShapeDataset(Dataset):
@@ -17,18 +20,17 @@ class ShapeDataset(Dataset):
     rgb = False
     single_id = False
 
-    def __init__(self, directory, subsample=1.):
+    def __init__(self, directory, subsample=1., cache=False):
         self.directory = directory
         index_path = os.path.join(directory, 'files.txt')
         if os.path.exists(index_path):
             with open(index_path, 'r') as f:
-                self.files = f.read().splitlines()
-            self.root = directory
+                self.files = sorted(f.read().splitlines())
         else:
-            self.files = glob(os.path.join(directory, '**/*.jpg'), recursive=True)
-            self.files += glob(os.path.join(directory, '**/*.png'), recursive=True)
-            self.root = None
-        self.files = sorted(self.files)
+            self.files = sorted(self.scan_files(directory))
+            if self.files:  # Don't index a directory that is still empty
+                self.write_index(index_path, self.files)
+        self.root = directory
 
         if subsample < 1:
             seed = np.random.get_state()
@@ -36,46 +38,96 @@ class ShapeDataset(Dataset):
             self.files = np.random.choice(self.files, int(len(self.files) * subsample), replace=False)
             np.random.set_state(seed)
 
+        # Group elements of all files at once, from quaternions in the names
+        quaternions = torch.tensor(
+            [self.filename_to_quaternion(f) for f in self.files],
+            dtype=torch.float32).view(-1, 4)
+        self._group_els = quaternions_to_group_matrix(quaternions)
+
+        # Object ids per file, indexed by sample instead of parsed per access
+        if self.single_id:
+            self._name_ids = torch.zeros(len(self.files), dtype=torch.long)
+        else:
+            self.names, name_ids = np.unique(
+                [self.filename_to_name(f) for f in self.files],
+                return_inverse=True)
+            self._name_ids = torch.from_numpy(name_ids.astype(np.int64))
+
+        self._cache = None
+        if cache:
+            self.fill_cache(range(len(self.files)))
+
     def __len__(self):
         return len(self.files)
 
     def __getitem__(self, idx):
-        filename = self.files[idx]
-        return self.load_file(filename, self.root)
+        return self.load_index(idx)
 
-    @classmethod
-    def load_file(cls, filename, root):
-        path = os.path.join(root, filename) if root else filename
-        image = Image.open(path)
-        image_tensor = torch.tensor(np.array(image), dtype=torch.float32) / 255
-        quaternion = cls.filename_to_quaternion(filename)
-
-        if not cls.rgb:
-            if image_tensor.dim() == 3:  # Mean if RGB
-                image_tensor = image_tensor.mean(-1)
+    @staticmethod
+    def write_index(index_path, files):
+        """Write files index, atomically so that it is never truncated."""
+        tmp_path = index_path + '.tmp'
+        try:  # Data dir may be read only
+            with open(tmp_path, 'w') as f:
+                f.write('\n'.join(files))
+            os.replace(tmp_path, index_path)
+            print('Wrote index of {} files to {}, delete it after adding data'
+                  .format(len(files), index_path))
+        except OSError:
+            pass
 
-            image_tensor = image_tensor.unsqueeze(0)  # Add color channel
+    @staticmethod
+    def scan_files(directory):
+        """Find images in directory, relative to it.
+
+        Like recursive glob, follows symlinks and skips hidden files."""
+        for root, dirnames, filenames in os.walk(directory, followlinks=True):
+            dirnames[:] = [d for d in dirnames if not d.startswith('.')]
+            for filename in filenames:
+                if filename.endswith(('.jpg', '.png')) \
+                        and not filename.startswith('.'):
+                    yield os.path.relpath(os.path.join(root, filename), directory)
+
+    def fill_cache(self, indices):
+        """Decode images of files at indices up front.
+
+        Done before workers fork, so that they share the cache."""
+        self._cache = [None] * len(self.files)
+        with ThreadPoolExecutor() as pool:
+            images = pool.map(
+                lambda i: self.load_image(self.files[i], self.root), indices)
+            for i, image in zip(indices, images):
+                self._cache[i] = image
+
+    def load_index(self, idx):
+        """Load sample by index into files, using the cache if enabled."""
+        if self._cache is not None:
+            image_tensor = self._cache[idx]
         else:
-            image_tensor = image_tensor[:, :, :3].permute(2, 0, 1)
+            image_tensor = self.load_image(self.files[idx], self.root)
+        return self._name_ids[idx], self._group_els[idx], image_tensor
 
-        group_el = torch.tensor(SO3_coordinates(quaternion, 'Q', 'MAT'),
-                                dtype=torch.float32)
-        name = 0 if cls.single_id else cls.filename_to_name(filename)
-
-        return name, group_el, image_tensor
+    @classmethod
+    def load_image(cls, filename, root):
+        """Decode image of file to uint8 CHW tensor."""
+        path = os.path.join(root, filename) if root else filename
+        # Decoder outputs CHW, dropping alpha or converting to gray as needed
+        mode = ImageReadMode.RGB if cls.rgb else ImageReadMode.GRAY
+        return read_image(path, mode)
 
     @classmethod
     def filename_to_quaternion(cls, filename):
         """Remove extension, then retrieve _ separated floats"""
-        matches = re.findall(r'-?[01]\.[0-9]{4}', filename)
-        assert len(matches) == 4, 'No quaternion found in '+filename
+        matches = _QUAT_RE.findall(filename)
+        if len(matches) != 4:
+            raise ValueError('No quaternion found in ' + filename)
         return [float(x) for x in matches]
 
     @classmethod
     def filename_to_name(cls, filename):
-        match = re.search(r'([A-z0-9]+)\.obj', filename)
-
-        assert match is not None, 'Could not find object id from filename'
+        match = _NAME_RE.search(filename)
+        if match is None:
+            raise ValueError('Could not find object id in ' + filename)
 
         return match.group(1)
 
@@ -83,20 +135,25 @@ class ShapeDataset(Dataset):
     def prep_batch(batch):
         return batch
 
+    @staticmethod
+    def prep_images(x):
+        """Map uint8 images to [0, 1] floats, after moving to device."""
+        return x.float().div_(255)
+
 
 class SphereCubeDataset(ShapeDataset):
     rgb = True
     single_id = True
 
-    def __init__(self, subsample=1.):
-        super().__init__('data/spherecube', subsample=subsample)
+    def __init__(self, subsample=1., cache=False):
+        super().__init__('data/spherecube', subsample=subsample, cache=cache)
 
 
 class ScPairsDataset(ShapeDataset):
     rgb = True
     single_id = True
 
-    def __init__(self, subsample=1.):
+    def __init__(self, subsample=1., cache=False):
         super().__init__('data/sc-pairs')
 
         n = len(self.files) // 2
@@ -108,15 +165,18 @@ class ScPairsDataset(ShapeDataset):
         else:
             self.indices = np.arange(n)
 
+        if cache:  # Only the files of the subsampled pairs
+            self.fill_cache([i for idx in self.indices
+                             for i in (2*idx, 2*idx+1)])
+
     def __len__(self):
         return len(self.indices)
 
     def __getitem__(self, idx):
         idx = self.indices[idx]
-        filenames = self.files[2*idx:2*idx+2]
-        assert len(filenames) == 2, "File not found"
-        names, gs, imgs = zip(*[self.load_file(f, self.root) for f in filenames])
-        names = torch.tensor(names)
+        assert 2*idx+1 < len(self.files), "File not found"
+        names, gs, imgs = zip(*[self.load_index(i) for i in (2*idx, 2*idx+1)])
+        names = torch.stack(names, 0)
         gs = torch.stack(gs, 0)
         imgs = torch.stack(imgs, 0)
         return names, gs, imgs
@@ -127,6 +187,57 @@ class ScPairsDataset(ShapeDataset):
         return [t.view(-1, *t.shape[2:]) for t in batch]  # Flatten pairs
 
 
+class PackedShapeDataset(TensorDataset):
+    """Shape dataset packed into memory mapped name, group and image arrays.
+
+    Images are stored as (N, C, H, W) uint8, so that loading a sample is
+    just some array slices. Use pack() and save() to create from a
+    ShapeDataset, see prepack.py.
+    """
+    num_workers = 0
+    array_names = ('names', 'group_el', 'images')
+
+    def __init__(self, tensors=None, path='data/spherecube-packed',
+                 subsample=1., cache=False):
+        """Load from path if no tensors given, into memory if cache.
+
+        Subsamples the same files as ShapeDataset, as packed files are
+        in ShapeDataset order."""
+        if tensors is None:
+            tensors = [torch.from_numpy(np.load(
+                os.path.join(path, name + '.npy'),
+                mmap_mode=(None if cache else 'c')))
+                for name in self.array_names]
+
+        if subsample < 1:
+            n = len(tensors[0])
+            seed = np.random.get_state()
+            np.random.seed(0)
+            indices = torch.from_numpy(np.random.choice(
+                n, int(n * subsample), replace=False).astype(np.int64, copy=False))
+            np.random.set_state(seed)
+            tensors = [t[indices] for t in tensors]
+        super().__init__(*tensors)
+        self.rgb = self.tensors[-1].shape[1] == 3
+
+    @classmethod
+    def pack(cls, dataset):
+        names, gs, imgs = zip(*[dataset[i] for i in range(len(dataset))])
+        return cls(tensors=(torch.stack(names, 0), torch.stack(gs, 0),
+                            torch.stack(imgs, 0)))
+
+    def save(self, path='data/spherecube-packed'):
+        os.makedirs(path, exist_ok=True)
+        for name, tensor in zip(self.array_names, self.tensors):
+            np.save(os.path.join(path, name + '.npy'), tensor.numpy())
+
+    @staticmethod
+    def prep_batch(batch):
+        return batch
+
+    prep_images = staticmethod(ShapeDataset.prep_images)
+
+
 class ToyDataset(TensorDataset):
     num_workers = 0
     single_id = True
@@ -150,7 +261,7 @@ class ToyDataset(TensorDataset):
             batch_n = min(i + batch_size, n)-i
             q = random_quaternions(batch_n, device=device)
             x = block_wigner_matrix_multiply(
-                quaternions_to_eazyz(q), harmonics.expand(batch_n, -1, -1), degrees)
+                quaternions_to_eazyz(q), harmonics, degrees)
             xs.append(x), qs.append(q)
         return cls(tensors=(torch.cat(qs, 0),
                             harmonics.expand(n, -1, -1),
@@ -163,3 +274,7 @@ class ToyDataset(TensorDataset):
     @staticmethod
     def prep_batch(batch):
         return batch
+
+    @staticmethod
+    def prep_images(x):
+        return x
@@ -5,13 +5,13 @@ import torch
 import torch.nn as nn
 from torch.utils.data import DataLoader
 from tensorboardX import SummaryWriter
-import numpy as np
 import yaml
 
-from lie_vae.experiments.datasets import SphereCubeDataset, ToyDataset, ScPairsDataset
+from lie_vae.experiments.datasets import SphereCubeDataset, ToyDataset, ScPairsDataset, \
+    PackedShapeDataset
 from lie_vae.experiments import UnsupervisedExperiment
 from lie_vae.experiments.vae import VAE
-from lie_vae.experiments.utils import random_split, LinearSchedule
+from lie_vae.experiments.utils import random_split, LinearSchedule, worker_kwargs
 from lie_vae.experiments.beta_schedule import get_beta_schedule
 
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
@@ -29,9 +29,12 @@ def main():
     item_rep = None  # Possibly given fixed harmonics
     batch_size = 64
     if args.dataset == 'spherecube':
-        dataset = SphereCubeDataset(subsample=args.subsample)
+        dataset = SphereCubeDataset(subsample=args.subsample, cache=args.cache)
+    elif args.dataset == 'spherecube-packed':
+        dataset = PackedShapeDataset(path='data/spherecube-packed',
+                                     subsample=args.subsample, cache=args.cache)
     elif args.dataset == 'sc-pairs':
-        dataset = ScPairsDataset(subsample=args.subsample)
+        dataset = ScPairsDataset(subsample=args.subsample, cache=args.cache)
         batch_size = 32
     elif args.dataset == 'toy':
         dataset = ToyDataset()
@@ -74,6 +77,11 @@ def main():
         model.load_state_dict(torch.load(os.path.join(
             args.save_dir, 'model.pickle')))
 
+    if args.compile:
+        # In place, so parameter names and saved models are unaffected
+        model.encoder.compile()
+        model.decoder.compile()
+
     num_valid = min(25000, int(0.2 * len(dataset)))
     num_test = min(25000, int(0.2 * len(dataset)))
 
@@ -134,10 +142,19 @@ def main():
     if not args.beta == 0:
         print('Computing LL..')
         model = model.eval()
-        loader = DataLoader(test_dataset, batch_size=1, shuffle=True, num_workers=1)
+        # Small batches, as each image is decoded for 500 samples
+        loader = DataLoader(test_dataset, batch_size=4, shuffle=False,
+                            pin_memory=device.type == 'cuda',
+                            **worker_kwargs(test_dataset.num_workers))
+        # Sum on device, weighted by batch size, to sync only once at the end
+        total, count = torch.zeros((), device=device), 0
         with torch.no_grad():
-            ll = np.mean([model.log_likelihood(test_dataset.prep_batch(batch)[-1].to(device), n=500).data.cpu().numpy()
-                          for batch in loader])
+            for batch in loader:
+                x = test_dataset.prep_batch(batch)[-1].to(device, non_blocking=True)
+                x = test_dataset.prep_images(x)
+                total += model.log_likelihood(x, n=500) * x.shape[0]
+                count += x.shape[0]
+        ll = (total / count).item()
         print('LL: {:.2f}'.format(ll))
         with open('ll.txt', 'a') as f:
             f.write("{} : {:4f}\n".format(args.name, ll))
@@ -147,7 +164,7 @@ def parse_args():
     parser = argparse.ArgumentParser('VAE experiment')
     parser.add_argument('--dataset', default='chairs',
                         help='Data set to use, [chairs, objects, objects3,'
-                             'spherecube, chumanoid, single]')
+                             'spherecube, spherecube-packed, chumanoid, single]')
     parser.add_argument('--decoder_mode', default='action',
                         help='[action, mlp]')
     parser.add_argument('--latent_mode', default='so3',
@@ -187,6 +204,10 @@ def parse_args():
                         'before doing early stopping.')
     parser.add_argument('--subsample', type=float, default=1.,
                         help='Part of the dataset to subsample in [0,1].')
+    parser.add_argument('--compile', action='store_true',
+                        help='Compile encoder and decoder with torch.compile.')
+    parser.add_argument('--cache', action='store_true',
+                        help='Load the image dataset into memory once.')
     parser.add_argument('--normal_dims', type=int, default=3,
                         help='Latent space dims for Normal')
     parser.add_argument('--deterministic', action='store_true',
@@ -0,0 +1,17 @@
+"""Pack image dataset into memory mapped arrays."""
+import argparse
+from lie_vae.experiments.datasets import SphereCubeDataset, PackedShapeDataset
+
+parser = argparse.ArgumentParser('Dataset packer')
+parser.add_argument('--dataset', default='spherecube', help='[spherecube]')
+parser.add_argument('--path', default='data/spherecube-packed')
+args = parser.parse_args()
+
+if args.dataset == 'spherecube':
+    dataset = SphereCubeDataset(cache=True)
+else:
+    raise RuntimeError('Wrong dataset')
+
+PackedShapeDataset.pack(dataset).save(args.path)
+
+print("Dataset packed")
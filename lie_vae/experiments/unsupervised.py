@@ -4,6 +4,7 @@ import torch
 from torch.utils.data import DataLoader
 from lie_vae.losses.equivariance_loss import EquivarianceLoss
 from lie_vae.losses.encoder_continuity_loss import EncoderContinuityLoss
+from lie_vae.experiments.utils import worker_kwargs
 
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
 
@@ -31,13 +32,20 @@ class UnsupervisedExperiment:
         self.test_dataset = test_dataset
         self.train_loader = DataLoader(
             train_dataset, batch_size=batch_size, shuffle=True,
-            num_workers=train_dataset.num_workers)
+            pin_memory=device.type == 'cuda',
+            **worker_kwargs(train_dataset.num_workers))
         self.test_loader = DataLoader(
             test_dataset, batch_size=batch_size, shuffle=True,
-            num_workers=test_dataset.num_workers)
+            pin_memory=device.type == 'cuda',
+            **worker_kwargs(test_dataset.num_workers))
         self.elbo_samples = elbo_samples
         self.clip_grads = clip_grads
         self.selective_clip = selective_clip
+        if selective_clip:
+            self.clip_params = list(model.encoder.parameters()) \
+                               + list(model.rep_group.parameters())
+        else:
+            self.clip_params = list(model.parameters())
         self.report_freq = report_freq
         self.best_value = np.inf
 
@@ -60,7 +68,8 @@ class UnsupervisedExperiment:
         losses = []
         for batch in self.test_loader:
             _, _, img_label = self.test_dataset.prep_batch(batch)
-            img_label = img_label.to(device)
+            img_label = self.test_dataset.prep_images(
+                img_label.to(device, non_blocking=True))
             recon, kl, kls = self.model.elbo(img_label, n=self.elbo_samples)
             losses.append((recon.mean().item(), kl.mean().item(),
                            *[x.mean().item() for x in kls]))
@@ -69,10 +78,11 @@ class UnsupervisedExperiment:
     def train(self, epoch):
         losses = []
         start = time()
+        self.model.train()
         for it, batch in enumerate(self.train_loader):
             _, _, img_label = self.train_dataset.prep_batch(batch)
-            self.model.train()
-            img_label = img_label.to(device)
+            img_label = self.train_dataset.prep_images(
+                img_label.to(device, non_blocking=True))
 
             global_it = epoch * len(self.train_loader) + it + 1
             beta = self.beta_schedule(global_it)
@@ -108,12 +118,7 @@ class UnsupervisedExperiment:
             self.optimizer.zero_grad()
             loss.backward()
             if self.clip_grads:
-                if self.selective_clip:
-                    params = list(self.model.encoder.parameters()) \
-                             + list(self.model.rep_group.parameters())
-                else:
-                    params = self.model.parameters()
-                torch.nn.utils.clip_grad_norm_(params, self.clip_grads)
+                torch.nn.utils.clip_grad_norm_(self.clip_params, self.clip_grads)
             self.optimizer.step()
 
             losses.append((recon.mean().item(), kl.mean().item(),
@@ -133,6 +138,7 @@ class UnsupervisedExperiment:
                 #     global_it)
 
                 test_recon, test_kl, *test_kls = self.test()
+                self.model.train()
                 self.best_value = self.best_value if test_recon > self.best_value else test_recon
                 self.log.add_scalar('test_loss', test_recon + beta * test_kl,
                                     global_it)
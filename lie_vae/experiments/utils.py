@@ -26,8 +26,8 @@ def random_split(dataset, lengths):
     assert sum(lengths) == len(dataset)
     seed = np.random.get_state()
     np.random.seed(0)
-    indices = torch.tensor(np.random.permutation(sum(lengths)),
-                           dtype=torch.long)
+    indices = torch.from_numpy(
+        np.random.permutation(sum(lengths)).astype(np.int64, copy=False))
     np.random.set_state(seed)
 
     return [Subset(dataset, indices[offset - length:offset])
@@ -72,6 +72,16 @@ class LinearSchedule:
                        self.min_y, self.max_y).item(0)
 
 
+def worker_kwargs(num_workers, prefetch_factor=4):
+    """DataLoader kwargs for persistent, prefetching worker processes.
+
+    Prefetching and persistence are only valid with worker processes."""
+    if num_workers == 0:
+        return dict(num_workers=0)
+    return dict(num_workers=num_workers, prefetch_factor=prefetch_factor,
+                persistent_workers=True)
+
+
 def cycle(iterable):
     """Cycle iterable non-caching."""
     while True:
@@ -25,22 +25,13 @@ def map_to_lie_algebra(v):
     # make sure this is a sample from R^3
     assert v.size()[-1] == 3
 
-    R_x = v.new_tensor([[ 0., 0., 0.],
-                        [ 0., 0.,-1.],
-                        [ 0., 1., 0.]])
-
-    R_y = v.new_tensor([[ 0., 0., 1.],
-                        [ 0., 0., 0.],
-                        [-1., 0., 0.]])
-
-    R_z = v.new_tensor([[ 0.,-1., 0.],
-                        [ 1., 0., 0.],
-                        [ 0., 0., 0.]])
-
-    R = R_x * v[..., 0, None, None] + \
-        R_y * v[..., 1, None, None] + \
-        R_z * v[..., 2, None, None]
-    return R
+    # Equal to R_x * v_x + R_y * v_y + R_z * v_z, with R_i the generators
+    x, y, z = v[..., 0], v[..., 1], v[..., 2]
+    zero = torch.zeros_like(x)
+    R = torch.stack((zero,   -z,    y,
+                        z, zero,   -x,
+                       -y,    x, zero), -1)
+    return R.view(*v.shape[:-1], 3, 3)
 
 
 def map_to_lie_vector(X):
@@ -54,7 +45,8 @@ def map_to_lie_vector(X):
 
 
 def rodrigues(v):
-    theta = v.norm(p=2, dim=-1, keepdim=True)
+    # Clamp, so that v = 0 maps to identity instead of NaN
+    theta = v.norm(p=2, dim=-1, keepdim=True).clamp(min=1E-8)
     # normalize K
     K = map_to_lie_algebra(v / theta)
 
@@ -192,16 +184,25 @@ def quaternions_to_group_matrix(q):
     ], -1).view(*q.shape[:-1], 3, 3)
 
 
-def _z_rot_mat(angle, l):
-    m = angle.new_zeros((angle.size(0), 2 * l + 1, 2 * l + 1))
-
+@lru_cache(maxsize=256)
+def _z_rot_indices(l, device, dtype):
+    """Index and frequency tensors for z rotations of degree l."""
+    device = torch.device(device)
     inds = torch.arange(
-        0, 2 * l + 1, 1, dtype=torch.long, device=angle.device)
+        0, 2 * l + 1, 1, dtype=torch.long, device=device)
     reversed_inds = torch.arange(
-        2 * l, -1, -1, dtype=torch.long, device=angle.device)
+        2 * l, -1, -1, dtype=torch.long, device=device)
 
     frequencies = torch.arange(
-        l, -l - 1, -1, dtype=angle.dtype, device=angle.device)[None]
+        l, -l - 1, -1, dtype=dtype, device=device)[None]
+    return inds, reversed_inds, frequencies
+
+
+def _z_rot_mat(angle, l):
+    m = angle.new_zeros((angle.size(0), 2 * l + 1, 2 * l + 1))
+
+    inds, reversed_inds, frequencies = _z_rot_indices(
+        l, str(angle.device), angle.dtype)
 
     m[:, inds, reversed_inds] = torch.sin(frequencies * angle[:, None])
     m[:, inds, inds] = torch.cos(frequencies * angle[:, None])
@@ -236,7 +237,8 @@ def block_wigner_matrix_multiply(angles, spectrum, max_degree, transpose=False):
 
     Input:
     - angles (batch, 3)  ZYZ Euler angles
-    - spectrum (batch, spectrum_dim, channels)
+    - spectrum (batch, spectrum_dim, channels), or (spectrum_dim, channels)
+      to transform a single spectrum shared by the batch
     - transpose whether to use transpose wigner matrices
 
     Output: (batch, spectrum_dim, channels)
@@ -248,9 +250,9 @@ def block_wigner_matrix_multiply(angles, spectrum, max_degree, transpose=False):
         matrix = wigner_d_matrix(angles, degree)
         if transpose:
             matrix = matrix.transpose(-2, -1)
-        outputs.append(matrix.bmm(spectrum[:, start:start + dim, :]))
+        outputs.append(matrix.matmul(spectrum[..., start:start + dim, :]))
         start += dim
-    return torch.cat(outputs, 1)
+    return torch.cat(outputs, -2)
 
 
 def random_quaternions(n, dtype=torch.float32, device=None):
@@ -291,6 +293,15 @@ def test_log_exp(scale, error):
                                    rtol=error, atol=error)
 
 
+def test_rodrigues_small_angles():
+    v = torch.randn(100, 3).double() * 1E-10
+    v[0] = 0
+    R = rodrigues(v)
+    R_ref = torch.eye(3, dtype=v.dtype) + map_to_lie_algebra(v)
+
+    np.testing.assert_allclose(R.detach(), R_ref.detach(), atol=1E-12)
+
+
 def test_coordinate_changes():
     from lie_learn.groups.SO3 import change_coordinates as SO3_coordinates
     r = random_group_matrices(10000, dtype=torch.float64)
@@ -357,6 +368,17 @@ def test_wigner_d_matrices():
         np.testing.assert_allclose(wc_result, wc, rtol=1E-3, atol=1E-3)
 
 
+def test_block_wigner_shared_spectrum():
+    angles = group_matrix_to_eazyz(random_group_matrices(100))
+    spectrum = torch.randn(7 ** 2, 10)
+
+    shared = block_wigner_matrix_multiply(angles, spectrum, 6)
+    batched = block_wigner_matrix_multiply(
+        angles, spectrum.expand(100, -1, -1), 6)
+
+    np.testing.assert_allclose(shared, batched, rtol=1E-5, atol=1E-5)
+
+
 def test_orthogonal(r):
     r = np.array(r).reshape(-1, r.shape[-1], r.shape[-1])
     eye = np.eye(r.shape[-1], dtype=r.dtype)[None]
@@ -441,8 +463,10 @@ def main():
     test_algebra_maps()
     test_log_exp(0.1, 1E-6)
     test_log_exp(10, 1E-6)
+    test_rodrigues_small_angles()
     test_coordinate_changes()
     test_wigner_d_matrices()
+    test_block_wigner_shared_spectrum()
     test_ref_wigner_d_matrices()
 
     print("All tests passed")
@@ -4,7 +4,6 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from lie_vae.lie_tools import s2s1rodrigues
-from lie_vae.experiments.utils import expand_dim
 
 
 class EquivarianceLoss(nn.Module):
@@ -25,9 +24,10 @@ class EquivarianceLoss(nn.Module):
             img, encoding = img[:self.num_samples], encoding[:self.num_samples]
         n = img.shape[0]
         theta = torch.rand(n, device=encoding.device) * 2 * pi
-        v = torch.tensor([1, 0, 0], dtype=torch.float32, device=encoding.device)
+        v = encoding.new_zeros((n, 3))
+        v[:, 0] = 1
         s1 = torch.stack((torch.cos(theta), torch.sin(theta)), 1)
-        g = s2s1rodrigues(expand_dim(v, n), s1)
+        g = s2s1rodrigues(v, s1)
 
         enc_rot = g.bmm(encoding)
         img_rot = self.rotate(img, theta)
@@ -263,8 +263,7 @@ class SO3reparameterize(nn.Module):
         return log_p
       
     def log_prior(self):
-        prior = torch.tensor([- np.log(8 * (np.pi ** 2))], device=self.z.device)
-        return prior.expand_as(self.z[..., 0, 0])
+        return self.z.new_full(self.z.shape[:-2], - np.log(8 * (np.pi ** 2)))
 
     def nsample(self, n=1):
         if self.return_means: